@@ -1,79 +1,347 @@
 # app.py
+import io
+import json
 import logging
 import os
-import uuid
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, stream_with_context, url_for
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import NotFound
 
-from engines.google_stt import handle_google_stt_request  # New for STT
+try:
+    import orjson  # Optional: faster JSON parsing of large request bodies
+except ImportError:
+    orjson = None
+
+from engines.google_stt import handle_google_stt_request, handle_google_stt_stream_request  # New for STT
 from engines.google_tts import handle_google_request
 # Import engine handlers
-from engines.piper_tts import handle_piper_request
+from engines.piper_tts import handle_piper_request, handle_piper_stream_request, preload_piper_voices
 from engines.persian_tts import handle_persian_request  # <-- Add this import
 from engines.facebook_tts import handle_facebook_request  # <-- Add this import
 #from engines.gujarati_tts import handle_gujarati_request  # <-- Add this import
-from utils import clear_audio_cache  # Shared utility
+from utils import CACHE_DIR, InvalidRequestError, cache_key, schedule_audio_cache_cleanup, write_cache_file  # Shared utility
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used for request bodies and jsonify responses."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 # Flask app setup
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 logging.basicConfig(level=logging.INFO)
+# Behind nginx/Apache, let the front server send cached files itself (X-Sendfile) instead of Python.
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
 
 # Configuration
 APP_PORT = 17100
+MAX_REQUEST_BYTES = 1_000_000
+MAX_TEXT_CHARS = 200_000
+# Cached audio is content-addressed and never changes, so clients may keep it this long (seconds).
+CACHED_AUDIO_MAX_AGE = 3600
+# Background synthesis jobs ("async": true) run on this many threads; uncollected results are dropped after the TTL.
+TTS_JOB_WORKERS = int(os.getenv('TTS_JOB_WORKERS', '8'))
+TTS_JOB_RESULT_TTL = int(os.getenv('TTS_JOB_RESULT_TTL', '600'))
+# New jobs are refused with 503 while this many are queued or running.
+TTS_MAX_PENDING_JOBS = int(os.getenv('TTS_MAX_PENDING_JOBS', '64'))
+# At most this many finished, uncollected results (and errors) are kept; the oldest are dropped first.
+TTS_MAX_RETAINED_JOBS = int(os.getenv('TTS_MAX_RETAINED_JOBS', '32'))
 debug_mode =  True #os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
 logging.info(f"Starting Flask app on port {APP_PORT} with debug={debug_mode}")
 
-# Clear cache on startup
-clear_audio_cache()
+# Clear the cache in the background on startup and periodically after that
+schedule_audio_cache_cleanup()
+
+# Load the Piper voices before serving so the first request doesn't pay for the model load.
+# Under Gunicorn this runs in each worker, after the fork.
+preload_piper_voices()
+
+# Engine name -> handler(data, text, format_param) returning the encoded audio bytes
+TTS_HANDLERS = {
+    'piper': handle_piper_request,
+    'google': handle_google_request,
+    'persian': handle_persian_request,  # New Persian TTS engine
+    'facebook': handle_facebook_request,  # Facebook TTS engine
+  #  'gujarati': handle_gujarati_request,  # Gujarati TTS engine
+}
+
+# Background jobs keyed by job id (the cache file name when cached), so identical requests share one synthesis.
+tts_job_executor = ThreadPoolExecutor(max_workers=TTS_JOB_WORKERS, thread_name_prefix='tts-job')
+TTS_JOBS = {}
+# Job id -> time.monotonic() deadline for finished jobs kept for polling, oldest first (every job gets the same TTL).
+TTS_JOB_EXPIRY = {}
+tts_jobs_pending = 0
+TTS_JOBS_LOCK = threading.Lock()
+# Synchronous syntheses in flight, keyed like TTS_JOBS. Each runs on the request thread that started it;
+# identical requests arriving meanwhile wait on its future instead of synthesizing again.
+TTS_INFLIGHT = {}
+TTS_INFLIGHT_LOCK = threading.Lock()
+
+
+def as_download():
+    """Send audio as an attachment only when the client asks with ?download=1, so browsers can play it inline."""
+    return request.args.get('download') == '1'
+
+
+def cached_audio_key(audio_file_path):
+    """The cache key a cached file is named after."""
+    return os.path.basename(audio_file_path).split('.', 1)[0]
+
+
+def download_name(format_param, audio_file_path=None):
+    """Client-side file name: a prefix of the cache key when the audio is cached, otherwise a short random token."""
+    if audio_file_path:
+        return f"output_{cached_audio_key(audio_file_path)[:16]}.{format_param}"
+    return f"output_{secrets.token_hex(8)}.{format_param}"
+
+
+def send_cached_audio(audio_file_path, format_param):
+    """Send a previously cached file, or return None if it is not (or no longer) in the cache."""
+    try:
+        os.utime(audio_file_path)  # Refresh mtime so the TTL cleanup keeps entries that are still in use
+    except FileNotFoundError:
+        return None
+    logging.info(f"Serving cached audio {audio_file_path}")
+    # The cache key is the ETag, so a repeat GET with If-None-Match gets a bodiless 304.
+    try:
+        return send_from_directory(CACHE_DIR, os.path.basename(audio_file_path), mimetype=f'audio/{format_param}',
+                                   as_attachment=as_download(),
+                                   download_name=download_name(format_param, audio_file_path),
+                                   conditional=True, etag=cached_audio_key(audio_file_path),
+                                   max_age=CACHED_AUDIO_MAX_AGE)
+    except NotFound:
+        return None  # Evicted by the cleanup between the utime and the send
+
+
+def send_audio(audio_data, format_param, audio_file_path=None):
+    """Send synthesized audio from memory; with `audio_file_path` (where it was cached) it also gets cache headers."""
+    cache_headers = {}
+    if audio_file_path:
+        cache_headers = {'etag': cached_audio_key(audio_file_path), 'max_age': CACHED_AUDIO_MAX_AGE}
+    return send_file(io.BytesIO(audio_data), mimetype=f'audio/{format_param}', as_attachment=as_download(),
+                     download_name=download_name(format_param, audio_file_path), **cache_headers)
+
+
+def forget_tts_job(job_id, future):
+    """Remove a job from TTS_JOBS, unless a newer job has since taken its id."""
+    with TTS_JOBS_LOCK:
+        if TTS_JOBS.get(job_id) is future:
+            del TTS_JOBS[job_id]
+            TTS_JOB_EXPIRY.pop(job_id, None)
+
+
+def expire_tts_jobs():
+    """Drop finished jobs whose TTL has passed, then the oldest beyond TTS_MAX_RETAINED_JOBS.
+
+    Call with TTS_JOBS_LOCK held.
+    """
+    now = time.monotonic()
+    while TTS_JOB_EXPIRY:
+        job_id, deadline = next(iter(TTS_JOB_EXPIRY.items()))
+        if deadline > now and len(TTS_JOB_EXPIRY) <= TTS_MAX_RETAINED_JOBS:
+            break
+        del TTS_JOB_EXPIRY[job_id]
+        del TTS_JOBS[job_id]
+
+
+def on_tts_job_done(job_id, future, audio_file_path):
+    """Drop finished jobs once their audio is written to the cache; keep other results and errors for the TTL."""
+    global tts_jobs_pending
+    cached = audio_file_path and future.exception() is None
+    with TTS_JOBS_LOCK:
+        tts_jobs_pending -= 1
+        if not cached and TTS_JOBS.get(job_id) is future:
+            TTS_JOB_EXPIRY[job_id] = time.monotonic() + TTS_JOB_RESULT_TTL
+        expire_tts_jobs()
+    if cached:
+        # Pollers can still read the result; the job stays visible until the cache can serve it instead.
+        written = write_cache_file(audio_file_path, future.result())
+        written.add_done_callback(lambda _: forget_tts_job(job_id, future))
+
+
+def submit_tts_job(job_id, engine, data, text, format_param, audio_file_path=None):
+    """Start a background synthesis job, or attach to the one already running under `job_id`.
+
+    Returns None when TTS_MAX_PENDING_JOBS jobs are already queued or running.
+    """
+    global tts_jobs_pending
+    with TTS_JOBS_LOCK:
+        expire_tts_jobs()
+        future = TTS_JOBS.get(job_id)
+        # A failed job is kept so pollers can see the error, but a new request retries instead of inheriting it.
+        if future is not None and not (future.done() and future.exception() is not None):
+            return future
+        if tts_jobs_pending >= TTS_MAX_PENDING_JOBS:
+            return None
+        future = tts_job_executor.submit(TTS_HANDLERS[engine], data, text, format_param)
+        TTS_JOBS[job_id] = future
+        TTS_JOB_EXPIRY.pop(job_id, None)
+        tts_jobs_pending += 1
+    # Registered outside the lock: the callback runs right away if the job has already finished, and takes the lock.
+    future.add_done_callback(lambda done: on_tts_job_done(job_id, done, audio_file_path))
+    return future
+
+
+def forget_inflight(job_id, future):
+    """Remove a synchronous synthesis from TTS_INFLIGHT, unless a newer one has since taken its id."""
+    with TTS_INFLIGHT_LOCK:
+        if TTS_INFLIGHT.get(job_id) is future:
+            del TTS_INFLIGHT[job_id]
+
+
+def synthesize_once(job_id, engine, data, text, format_param, audio_file_path):
+    """Synthesize on this request thread and cache the result, or wait for the identical synthesis in flight."""
+    with TTS_INFLIGHT_LOCK:
+        future = TTS_INFLIGHT.get(job_id)
+        owner = future is None
+        if owner:
+            future = TTS_INFLIGHT[job_id] = Future()
+    if not owner:
+        return future.result()
+
+    try:
+        audio_data = TTS_HANDLERS[engine](data, text, format_param)
+    except BaseException as e:
+        # Waiters get the same error; the entry goes at once so the next request retries.
+        future.set_exception(e)
+        forget_inflight(job_id, future)
+        raise
+    future.set_result(audio_data)
+    # Keep the entry until the file is on disk, so no request falls between the two and synthesizes again.
+    write_cache_file(audio_file_path, audio_data).add_done_callback(lambda _: forget_inflight(job_id, future))
+    return audio_data
 
 
 @app.route('/tts', methods=['POST'])
 def tts_endpoint():
     """TTS API Endpoint. Routes to the appropriate TTS engine handler."""
     try:
-        data = request.json
-        engine = data.get('engine', 'piper').lower()
-        text = data.get('text', '').strip()
-        format_param = data.get('format', 'wav').lower()
+        # Cheap guards first, so malformed or oversized traffic never reaches synthesis
+        if request.content_length and request.content_length > MAX_REQUEST_BYTES:
+            return jsonify({"error": "Request too large."}), 413
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object."}), 400
+        text = data.get('text', '')
+        if not isinstance(text, str):
+            return jsonify({"error": "Text must be a string."}), 400
+        if len(text) > MAX_TEXT_CHARS:
+            return jsonify({"error": f"Text exceeds {MAX_TEXT_CHARS} characters."}), 413
+
+        engine = str(data.get('engine', 'piper')).lower()
+        text = text.strip()
+        format_param = str(data.get('format', 'wav')).lower()
+        stream = data.get('stream', False)
+        async_job = data.get('async', False)
+        # bool("false") is True, so only real JSON booleans are accepted
+        if not isinstance(stream, bool) or not isinstance(async_job, bool):
+            return jsonify({"error": "'stream' and 'async' must be true or false."}), 400
 
         if not text:
             return jsonify({"error": "Text is required."}), 400
         if format_param not in ['wav', 'mp3']:
             return jsonify({"error": "Invalid format. Use 'wav' or 'mp3'."}), 400
+        if engine not in TTS_HANDLERS:
+            return jsonify({"error": f"Invalid engine '{engine}'. Use 'piper', 'google', 'persian', 'facebook', or 'gujarati'."}), 400
+        if stream and engine != 'piper':
+            return jsonify({"error": "Streaming is only supported for the 'piper' engine."}), 400
+        if stream and async_job:
+            return jsonify({"error": "Use either 'stream' or 'async', not both."}), 400
 
-        if engine == 'piper':
-            audio_file_path = handle_piper_request(data, text, format_param)
-            return send_file(audio_file_path, mimetype=f'audio/{format_param}', as_attachment=True,
-                             download_name=f'output_{uuid.uuid4()}.{format_param}')
-
-        elif engine == 'google':
-            audio_file_path = handle_google_request(data, text, format_param)
-            return send_file(audio_file_path, mimetype=f'audio/{format_param}', as_attachment=True,
-                             download_name=f'output_{uuid.uuid4()}.{format_param}')
+        if engine == 'piper' and stream:
+            audio_stream = handle_piper_stream_request(data, text, format_param)
+            return Response(stream_with_context(audio_stream), mimetype=f'audio/{format_param}')
 
-        elif engine == 'persian':  # New Persian TTS engine
-            audio_file_path = handle_persian_request(data, text, format_param)
-            return send_file(audio_file_path, mimetype=f'audio/{format_param}', as_attachment=True,
-                             download_name=f'output_{uuid.uuid4()}.{format_param}')
+        # Identical requests are served from the cache unless the caller opts out with ?cache=false
+        audio_file_path = None
+        job_id = f"{secrets.token_hex(16)}.{format_param}"
+        if request.args.get('cache', 'true').lower() != 'false':
+            # Delivery options don't change the audio, so they stay out of the key.
+            key_params = {k: v for k, v in data.items() if k not in ('stream', 'async')}
+            key = cache_key(engine, text, dict(key_params, format=format_param))
+            job_id = f"{key}.{format_param}"
+            audio_file_path = os.path.join(CACHE_DIR, job_id)
+            cached_response = send_cached_audio(audio_file_path, format_param)
+            if cached_response is not None:
+                return cached_response
 
-        elif engine == 'facebook':  # Facebook TTS engine
-            audio_file_path = handle_facebook_request(data, text, format_param)
-            return send_file(audio_file_path, mimetype=f'audio/{format_param}', as_attachment=True,
-                             download_name=f'output_{uuid.uuid4()}.{format_param}')
+        # With "async": true, reply at once and let the client poll GET /tts/<job_id> for the audio
+        if async_job:
+            if submit_tts_job(job_id, engine, data, text, format_param, audio_file_path) is None:
+                return jsonify({"error": "Too many pending TTS jobs. Try again later."}), 503, {'Retry-After': '5'}
+            job_url = url_for('tts_job_endpoint', job_id=job_id)
+            return jsonify({"job_id": job_id, "status_url": job_url}), 202, {'Location': job_url}
 
-      #  elif engine == 'gujarati':  # Gujarati TTS engine
-      #      audio_file_path = handle_gujarati_request(data, text, format_param)
-      #      return send_file(audio_file_path, mimetype=f'audio/{format_param}', as_attachment=True,
-      #                       download_name=f'output_{uuid.uuid4()}.{format_param}')
+        if audio_file_path is None:
+            audio_data = TTS_HANDLERS[engine](data, text, format_param)
+            return send_audio(audio_data, format_param)
 
-        else:
-            return jsonify({"error": f"Invalid engine '{engine}'. Use 'piper', 'google', 'persian', 'facebook', or 'gujarati'."}), 400
+        # Concurrent identical requests wait on the same job instead of each synthesizing the same audio
+        audio_data = synthesize_once(job_id, engine, data, text, format_param, audio_file_path)
+        return send_audio(audio_data, format_param, audio_file_path)
 
+    except InvalidRequestError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.error(f"Error in TTS endpoint: {e}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 
+@app.route('/tts/<job_id>', methods=['GET'])
+def tts_job_endpoint(job_id):
+    """Poll a background TTS job. Returns 202 while it is running and the audio once it is done."""
+    try:
+        format_param = job_id.rsplit('.', 1)[-1]
+        with TTS_JOBS_LOCK:
+            expire_tts_jobs()
+            future = TTS_JOBS.get(job_id)
+        if future is not None:
+            if not future.done():
+                return jsonify({"job_id": job_id, "status": "pending"}), 202
+            error = future.exception()
+            if isinstance(error, InvalidRequestError):
+                return jsonify({"error": str(error)}), 400
+            if error is not None:
+                logging.error(f"Error in TTS job {job_id}: {error}")
+                return jsonify({"error": f"Internal server error: {str(error)}"}), 500
+            return send_audio(future.result(), format_param)
+
+        # Finished cached jobs are served straight from the cache
+        if format_param in ['wav', 'mp3'] and os.path.basename(job_id) == job_id:
+            cached_response = send_cached_audio(os.path.join(CACHE_DIR, job_id), format_param)
+            if cached_response is not None:
+                return cached_response
+        return jsonify({"error": f"Unknown job '{job_id}'."}), 404
+
+    except Exception as e:
+        logging.error(f"Error in TTS job endpoint: {e}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+
+def stt_events(audio_file, language_code, sample_rate_hertz):
+    """Server-sent events with each interim and final transcript as it arrives, then a closing `done` event."""
+    try:
+        for transcript, is_final in handle_google_stt_stream_request(audio_file, language_code, sample_rate_hertz):
+            yield f"data: {json.dumps({'transcript': transcript, 'is_final': is_final})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+    except Exception as e:
+        logging.error(f"Error in STT stream: {e}")
+        error = {"error": f"Internal server error: {str(e)}"}
+        yield f"event: error\ndata: {json.dumps(error)}\n\n"
+
+
 @app.route('/stt', methods=['POST'])
 def stt_endpoint():
     """STT API Endpoint. Routes to the Google STT handler."""
@@ -84,12 +352,17 @@ def stt_endpoint():
         audio_file = request.files.get('audio')  # Expect an audio file in the request
         language_code = data.get('language_code', 'en-US')  # Default to en-US
         sample_rate_hertz = int(data.get('sample_rate_hertz', 16000))  # Default sample rate
+        stream = data.get('stream', 'false').lower() == 'true'  # Interim transcripts as server-sent events
 
         if not audio_file:
             return jsonify({"error": "Audio file is required."}), 400
         if audio_file.filename.split('.')[-1].lower() not in ['wav', 'mp3']:
             return jsonify({"error": "Unsupported audio format. Use 'wav' or 'mp3'."}), 400
 
+        if stream:
+            return Response(stream_with_context(stt_events(audio_file, language_code, sample_rate_hertz)),
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
         transcription = handle_google_stt_request(audio_file, language_code, sample_rate_hertz)
         return jsonify({"transcription": transcription}), 200  # Return transcribed text as JSON
 
@@ -99,5 +372,6 @@ def stt_endpoint():
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=APP_PORT, debug=debug_mode)
+    # Local development only; deploy with `gunicorn -c gunicorn_conf.py app:app`.
+    app.run(host='0.0.0.0', port=APP_PORT, debug=debug_mode, threaded=True)
 
@@ -1,42 +1,30 @@
-import os
-import uuid
 import torch
 from transformers import VitsModel, AutoTokenizer
 import scipy.io.wavfile
 import io
-from pydub import AudioSegment
+
+from utils import encode_mp3, float_to_int16
 
 # Load model and tokenizer once at import time
-model = VitsModel.from_pretrained("facebook/mms-tts-eng")
+device = "cuda" if torch.cuda.is_available() else "cpu"
+model = VitsModel.from_pretrained("facebook/mms-tts-eng").to(device).eval()
 tokenizer = AutoTokenizer.from_pretrained("facebook/mms-tts-eng")
 
 def handle_facebook_request(data, text, format_param):
     # Tokenize input text
-    inputs = tokenizer(text, return_tensors="pt")
-    # Generate waveform
-    with torch.no_grad():
+    inputs = tokenizer(text, return_tensors="pt").to(device)
+    # Generate waveform; bf16 autocast only applies on GPU
+    with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=device == "cuda"):
         output = model(**inputs).waveform
-    # Prepare output file path
-    out_dir = "audio_cache"
-    os.makedirs(out_dir, exist_ok=True)
-    file_ext = format_param if format_param in ["wav", "mp3"] else "wav"
-    out_path = os.path.join(out_dir, f"facebook_{uuid.uuid4()}.{file_ext}")
-
-    # Save as WAV or MP3
-    wav_data = output.squeeze().cpu().numpy()
+    # Quantize to 16-bit once; this also halves the WAV size compared with float32
+    pcm = float_to_int16(output.squeeze().float().cpu().numpy())
     sample_rate = model.config.sampling_rate
 
-    if format_param == "wav":
-        scipy.io.wavfile.write(out_path, rate=sample_rate, data=wav_data)
-    elif format_param == "mp3":
-        # Write to a BytesIO buffer as WAV, then convert to MP3
-        buf = io.BytesIO()
-        scipy.io.wavfile.write(buf, rate=sample_rate, data=wav_data)
-        buf.seek(0)
-        audio = AudioSegment.from_wav(buf)
-        audio.export(out_path, format="mp3")
-    else:
-        # Default to WAV if unknown format
-        scipy.io.wavfile.write(out_path, rate=sample_rate, data=wav_data)
+    # Encode as WAV or MP3 in memory
+    if format_param == "mp3":
+        # Pipe 16-bit PCM straight into ffmpeg
+        return encode_mp3(pcm.tobytes(), sample_rate)
 
-    return out_path
+    buf = io.BytesIO()
+    scipy.io.wavfile.write(buf, rate=sample_rate, data=pcm)
+    return buf.getvalue()
@@ -1,33 +1,100 @@
 # engines/google_stt.py
+import asyncio
 import io
 import logging
 from google.cloud import speech_v1 as speech
 
+from utils import iterate_async, run_async
+
+# Audio is sent to the streaming API in frames of this size, so recognition starts before the whole file is sent.
+STT_STREAM_CHUNK_BYTES = 16 * 1024
+
+
+async def _create_speech_client():
+    # The async client binds to the running loop, so it is created on the shared background loop.
+    return speech.SpeechAsyncClient()
+
+
 try:
-    speech_client = speech.SpeechClient()
+    speech_client = run_async(_create_speech_client())
     STT_AVAILABLE = True
 except Exception as e:
     speech_client = None
     STT_AVAILABLE = False
     logging.error(f"Failed to initialize Google Cloud STT: {e}")
 
-def handle_google_stt_request(audio_file, language_code='en-US', sample_rate_hertz=16000):
-    """Handle speech-to-text using Google Cloud STT."""
-    if not STT_AVAILABLE:
-        raise NotImplementedError("Google Cloud STT is not available. Check credentials.")
 
-    audio_content = audio_file.read()
-    audio = speech.RecognitionAudio(content=audio_content)
-    config = speech.RecognitionConfig(
+def _recognition_config(language_code, sample_rate_hertz):
+    return speech.RecognitionConfig(
         encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,  # Adjust based on input file
         sample_rate_hertz=sample_rate_hertz,
         language_code=language_code,
     )
 
+
+async def recognize_google_async(audio_content, language_code='en-US', sample_rate_hertz=16000):
+    """Transcribe audio with Google Cloud STT without blocking the event loop."""
+    if not STT_AVAILABLE:
+        raise NotImplementedError("Google Cloud STT is not available. Check credentials.")
+
+    audio = speech.RecognitionAudio(content=audio_content)
+    config = _recognition_config(language_code, sample_rate_hertz)
+    response = await speech_client.recognize(config=config, audio=audio)
+    return ' '.join([result.alternatives[0].transcript for result in response.results])
+
+
+def handle_google_stt_request(audio_file, language_code='en-US', sample_rate_hertz=16000):
+    """Handle speech-to-text using Google Cloud STT."""
+    if not STT_AVAILABLE:
+        raise NotImplementedError("Google Cloud STT is not available. Check credentials.")
+
+    audio_content = audio_file.read()
     try:
-        response = speech_client.recognize(config=config, audio=audio)
-        transcription = ' '.join([result.alternatives[0].transcript for result in response.results])
-        return transcription
+        return run_async(recognize_google_async(audio_content, language_code, sample_rate_hertz))
     except Exception as e:
         logging.error(f"STT Error: {e}")
         raise
+
+
+async def _streaming_requests(audio_stream, streaming_config):
+    """The config message first, then the audio in STT_STREAM_CHUNK_BYTES frames."""
+    yield speech.StreamingRecognizeRequest(streaming_config=streaming_config)
+    while True:
+        # The upload is spooled to memory or a temp file; read it off the event loop all the same.
+        chunk = await asyncio.to_thread(audio_stream.read, STT_STREAM_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+
+async def open_google_stt_stream(audio_stream, language_code='en-US', sample_rate_hertz=16000):
+    """Start a streaming recognition with interim results and return the async iterable of responses."""
+    streaming_config = speech.StreamingRecognitionConfig(
+        config=_recognition_config(language_code, sample_rate_hertz),
+        interim_results=True,
+    )
+    return await speech_client.streaming_recognize(requests=_streaming_requests(audio_stream, streaming_config))
+
+
+async def _cancel_stream(responses):
+    # gRPC calls belong to the shared loop, so they are cancelled from it.
+    responses.cancel()
+
+
+def handle_google_stt_stream_request(audio_file, language_code='en-US', sample_rate_hertz=16000):
+    """Yield (transcript, is_final) pairs as Google Cloud STT returns interim and final results."""
+    if not STT_AVAILABLE:
+        raise NotImplementedError("Google Cloud STT is not available. Check credentials.")
+
+    responses = run_async(open_google_stt_stream(audio_file.stream, language_code, sample_rate_hertz))
+    finished = False
+    try:
+        for response in iterate_async(responses):
+            for result in response.results:
+                if result.alternatives:
+                    yield result.alternatives[0].transcript, result.is_final
+        finished = True
+    finally:
+        if not finished:
+            # The client went away (or an error cut the stream short): stop the call so it stops reading the upload.
+            run_async(_cancel_stream(responses))
@@ -1,29 +1,36 @@
 # engines/google_tts.py
+import asyncio
 import logging
 import os
-import uuid
 
 from google.api_core import exceptions as google_exceptions
 from google.cloud import texttospeech
 
+from utils import run_async
+
+# Cap on Google TTS calls in flight per process, to stay within the project's request quota.
+GOOGLE_TTS_MAX_CONCURRENCY = int(os.getenv('GOOGLE_TTS_MAX_CONCURRENCY', '16'))
+
+
+async def _create_google_tts_client():
+    # The async client and the semaphore bind to the running loop, so they are created on the shared background loop.
+    return texttospeech.TextToSpeechAsyncClient(), asyncio.Semaphore(GOOGLE_TTS_MAX_CONCURRENCY)
+
+
 try:
-    google_tts_client = texttospeech.TextToSpeechClient()
+    google_tts_client, google_tts_semaphore = run_async(_create_google_tts_client())
     GOOGLE_AVAILABLE = True
 except Exception as e:
-    google_tts_client = None
+    google_tts_client = google_tts_semaphore = None
     GOOGLE_AVAILABLE = False
     logging.error(f"Failed to initialize Google Cloud TTS: {e}")
 
-CACHE_DIR = os.path.join(os.getcwd(), 'cache')
-os.makedirs(CACHE_DIR, exist_ok=True)
-
 
-def generate_audio_google(text, voice_name, format='wav', speaking_rate=1.0, pitch=0.0):
-    """Generate audio from text using Google Cloud TTS."""
+async def synthesize_google_async(text, voice_name, format='wav', speaking_rate=1.0, pitch=0.0):
+    """Synthesize text with Google Cloud TTS without blocking the event loop. Returns the encoded audio bytes."""
     if not GOOGLE_AVAILABLE:
         raise NotImplementedError("Google Cloud TTS client is not initialized.")
 
-    logging.info(f"Generating audio with Google TTS. Voice: {voice_name}, Format: {format}")
     synthesis_input = texttospeech.SynthesisInput(text=text)
     lang_code = 'en-US'  # Default
     if voice_name and len(voice_name.split('-')) >= 2:
@@ -33,15 +40,22 @@ def generate_audio_google(text, voice_name, format='wav', speaking_rate=1.0, pit
     audio_encoding = texttospeech.AudioEncoding.LINEAR16 if format == 'wav' else texttospeech.AudioEncoding.MP3
     audio_config = texttospeech.AudioConfig(audio_encoding=audio_encoding, speaking_rate=speaking_rate, pitch=pitch)
 
+    async with google_tts_semaphore:
+        response = await google_tts_client.synthesize_speech(input=synthesis_input, voice=voice_params,
+                                                             audio_config=audio_config)
+    return response.audio_content
+
+
+def generate_audio_google(text, voice_name, format='wav', speaking_rate=1.0, pitch=0.0):
+    """Generate audio from text using Google Cloud TTS. Returns the encoded audio bytes."""
+    if not GOOGLE_AVAILABLE:
+        raise NotImplementedError("Google Cloud TTS client is not initialized.")
+
+    logging.info(f"Generating audio with Google TTS. Voice: {voice_name}, Format: {format}")
     try:
-        response = google_tts_client.synthesize_speech(input=synthesis_input, voice=voice_params,
-                                                       audio_config=audio_config)
-        audio_data = response.audio_content
-        audio_file_path = os.path.join(CACHE_DIR, f"{str(uuid.uuid4())}.{format}")
-        with open(audio_file_path, 'wb') as audio_file:
-            audio_file.write(audio_data)
-        logging.info(f"Google audio generated and saved to {audio_file_path}")
-        return audio_file_path
+        audio_data = run_async(synthesize_google_async(text, voice_name, format, speaking_rate, pitch))
+        logging.info(f"Google audio generated ({len(audio_data)} bytes)")
+        return audio_data
     except google_exceptions.GoogleAPIError as e:
         logging.error(f"Google TTS API Error: {e}")
         raise
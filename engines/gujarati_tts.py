@@ -1,39 +1,34 @@
-import os
-import uuid
+import io
 import numpy as np
 import soundfile as sf
+import torch
 from transformers import AutoModel
 
+from utils import encode_mp3, float_to_int16
+
 # Load model once at import time
 repo_id = "ai4bharat/IndicF5"
-model = AutoModel.from_pretrained(repo_id, trust_remote_code=True)
+device = "cuda" if torch.cuda.is_available() else "cpu"
+model = AutoModel.from_pretrained(repo_id, trust_remote_code=True).to(device).eval()
 
 def handle_gujarati_request(data, text, format_param):
-    # Synthesize audio
-    audio = model(text)
-    # Normalize if needed
+    # Synthesize audio; bf16 autocast only applies on GPU
+    with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=device == "cuda"):
+        audio = model(text)
+    if isinstance(audio, torch.Tensor):
+        audio = audio.float().cpu().numpy()
+    # Quantize float output to 16-bit; int16 output is already in the right form
     if hasattr(audio, "dtype") and audio.dtype == np.int16:
-        audio = audio.astype(np.float32) / 32768.0
-
-    # Prepare output file path
-    out_dir = "audio_cache"
-    os.makedirs(out_dir, exist_ok=True)
-    file_ext = format_param if format_param in ["wav", "mp3"] else "wav"
-    out_path = os.path.join(out_dir, f"gujarati_{uuid.uuid4()}.{file_ext}")
+        pcm = audio
+    else:
+        pcm = float_to_int16(np.asarray(audio, dtype=np.float32))
 
-    # Save as WAV or MP3
+    # Encode as WAV or MP3 in memory
     sample_rate = model.config.sampling_rate
-    if format_param == "wav":
-        sf.write(out_path, audio, sample_rate)
-    elif format_param == "mp3":
-        import io
-        from pydub import AudioSegment
-        buf = io.BytesIO()
-        sf.write(buf, audio, sample_rate, format="WAV")
-        buf.seek(0)
-        audio_seg = AudioSegment.from_wav(buf)
-        audio_seg.export(out_path, format="mp3")
-    else:
-        sf.write(out_path, audio, sample_rate)
+    if format_param == "mp3":
+        # Pipe 16-bit PCM straight into ffmpeg
+        return encode_mp3(pcm.tobytes(), sample_rate)
 
-    return out_path
+    buf = io.BytesIO()
+    sf.write(buf, pcm, sample_rate, format="WAV", subtype="PCM_16")
+    return buf.getvalue()
@@ -1,15 +1,22 @@
 # engines/piper_tts.py
+import functools
 import io
 import logging
 import os
-import uuid
+import re
+import struct
+import threading
 import wave
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import pydub
+import numpy as np
+
+from utils import InvalidRequestError, encode_mp3, stream_mp3
 
 # Assuming piper_tts library is installed
 try:
+    import onnxruntime
     from piper_tts import PiperVoice
 
     PIPER_AVAILABLE = True
@@ -23,38 +30,97 @@ except ImportError:
     logging.warning("piper_tts library not found. The 'piper' engine will not be available.")
 
 VOICES_DIR = os.path.join(os.getcwd(), 'voices')
-CACHE_DIR = os.path.join(os.getcwd(), 'cache')
 os.makedirs(VOICES_DIR, exist_ok=True)
-os.makedirs(CACHE_DIR, exist_ok=True)
 
 AVAILABLE_PIPER_VOICES = {
     'en_us': os.path.join(VOICES_DIR, 'en_US-ryan-high.onnx'),
     'en_gb': os.path.join(VOICES_DIR, 'en_GB-cori-high.onnx'),
-    'en_us_female': os.path.join(VOICES_DIR, 'en_US-lessac-high'),
+    'en_us_female': os.path.join(VOICES_DIR, 'en_US-lessac-high.onnx'),
 }
 
+# Long texts are split on sentence boundaries into chunks of about PIPER_CHUNK_WORDS words.
+PIPER_CHUNK_WORDS = 450
+PIPER_MAX_CHUNK_WORDS = 500
+# Upper bound for the client-supplied pause between sentences, in seconds.
+PIPER_MAX_SENTENCE_SILENCE = 5.0
+# A sentence runs from its first non-space character to terminal punctuation followed by whitespace, or to the end.
+_SENTENCE_RE = re.compile(r'\S.*?(?:[.!?]+(?=\s)|\Z)', re.DOTALL)
+_WORD_GAP_RE = re.compile(r'\s+')
+
+# Long texts are synthesized chunk by chunk on a shared, bounded pool.
+PIPER_CONCURRENCY = int(os.getenv('PIPER_CONCURRENCY', '3'))
+_PIPER_POOL = ThreadPoolExecutor(max_workers=PIPER_CONCURRENCY, thread_name_prefix='piper')
+# ONNX Runtime otherwise starts one intra-op thread per core in every session, which oversubscribes the CPU
+# once several Gunicorn workers and pool threads run at the same time.
+PIPER_THREADS = int(os.getenv('PIPER_THREADS', '2'))
+_VOICE_LOAD_LOCK = threading.Lock()
+# Loaded voices keyed by voice key. ONNX Runtime sessions are safe to run from several threads at once.
+_VOICE_CACHE = {}
+
+
+def _piper_session_options():
+    """ONNX Runtime session options for Piper voices: full graph optimization and PIPER_THREADS intra-op threads."""
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = PIPER_THREADS
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return sess_options
+
+
+def _piper_use_cuda():
+    """Use the CUDA provider (with CPU fallback) whenever this ONNX Runtime build offers it."""
+    return 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+
 
 def load_piper_voice(voice_key):
-    """Load the PiperVoice model."""
+    """Load the PiperVoice model, reusing the instance loaded by an earlier call."""
     if not PIPER_AVAILABLE:
         raise NotImplementedError("piper_tts library is not installed or available.")
 
     if voice_key not in AVAILABLE_PIPER_VOICES:
         raise ValueError(f"Piper voice '{voice_key}' is not available. Choices: {list(AVAILABLE_PIPER_VOICES.keys())}")
+
+    voice = _VOICE_CACHE.get(voice_key)
+    if voice is not None:
+        return voice
+
     model_path = Path(AVAILABLE_PIPER_VOICES[voice_key])
     config_path = None
     if not model_path.exists():
         raise FileNotFoundError(f"Model file not found for Piper voice '{voice_key}': {model_path}")
 
-    return PiperVoice.load(str(model_path), config_path=config_path, use_cuda=False)
+    # Parallel chunks would otherwise all race to load the same model at once.
+    with _VOICE_LOAD_LOCK:
+        voice = _VOICE_CACHE.get(voice_key)
+        if voice is None:
+            logging.info(f"Loading Piper voice '{voice_key}' from {model_path}")
+            voice = PiperVoice.load(str(model_path), config_path=config_path, use_cuda=_piper_use_cuda(),
+                                    sess_options=_piper_session_options())
+            _VOICE_CACHE[voice_key] = voice
+        return voice
 
 
-def generate_audio_piper(text, voice_key, format='wav', speaker_id=0, length_scale=None, noise_scale=None, noise_w=None,
-                         sentence_silence=0.0):
-    """Generate audio from text using Piper TTS."""
-    logging.info(f"Generating audio with Piper TTS. Voice: {voice_key}, Format: {format}")
-    voice_instance = load_piper_voice(voice_key)
+def preload_piper_voices(warm_up=True):
+    """Load every available Piper voice ahead of time so the first request doesn't pay for it.
+
+    With `warm_up`, each voice also synthesizes one word so ONNX Runtime finishes its lazy initialization now.
+    """
+    if not PIPER_AVAILABLE:
+        return
+
+    for voice_key in AVAILABLE_PIPER_VOICES:
+        try:
+            voice_instance = load_piper_voice(voice_key)
+            if warm_up:
+                for _ in voice_instance.synthesize_stream_raw("Hello."):
+                    pass
+        except FileNotFoundError as e:
+            logging.warning(f"Skipping Piper voice preload: {e}")
+        except Exception as e:
+            logging.error(f"Error preloading Piper voice '{voice_key}': {e}")
+
 
+def _piper_synthesize_args(speaker_id, length_scale, noise_scale, noise_w, sentence_silence):
+    """Build the keyword arguments for Piper synthesis, leaving unset values to the voice config."""
     synthesize_args = {
         "speaker_id": speaker_id,
         "length_scale": length_scale,
@@ -62,89 +128,250 @@ def generate_audio_piper(text, voice_key, format='wav', speaker_id=0, length_sca
         "noise_w": noise_w,
         "sentence_silence": sentence_silence,
     }
+    return {k: v for k, v in synthesize_args.items() if v is not None}
 
-    audio_buffer = io.BytesIO()
-    try:
-        with wave.open(audio_buffer, 'wb') as wav_file:
-            voice_instance.synthesize(text, wav_file, **{k: v for k, v in synthesize_args.items() if v is not None})
-        audio_buffer.seek(0)
-        audio_data = audio_buffer.read()
 
+def generate_audio_piper(text, voice_key, format='wav', speaker_id=0, length_scale=None, noise_scale=None, noise_w=None,
+                         sentence_silence=0.0):
+    """Generate audio from text using Piper TTS. Returns the encoded audio bytes."""
+    logging.info(f"Generating audio with Piper TTS. Voice: {voice_key}, Format: {format}")
+    voice_instance = load_piper_voice(voice_key)
+    synthesize_args = _piper_synthesize_args(speaker_id, length_scale, noise_scale, noise_w, sentence_silence)
+
+    try:
         if format == 'mp3':
-            audio_segment = pydub.AudioSegment.from_wav(io.BytesIO(audio_data))
-            audio_buffer = io.BytesIO()
-            audio_segment.export(audio_buffer, format='mp3')
-            audio_buffer.seek(0)
-            audio_data = audio_buffer.read()
+            # Raw PCM goes straight into ffmpeg; no WAV container to build and parse again.
+            pcm_bytes = b''.join(voice_instance.synthesize_stream_raw(text, **synthesize_args))
+            return encode_mp3(pcm_bytes, voice_instance.config.sample_rate)
+
+        audio_buffer = io.BytesIO()
+        with wave.open(audio_buffer, 'wb') as wav_file:
+            voice_instance.synthesize(text, wav_file, **synthesize_args)
+        # getvalue() hands over the buffer's own bytes object rather than copying it,
+        # as long as nothing writes to the buffer afterwards.
+        return audio_buffer.getvalue()
     except Exception as e:
         logging.error(f"Error during Piper synthesis or conversion: {e}")
         raise
 
-    audio_file_path = os.path.join(CACHE_DIR, f"{str(uuid.uuid4())}.{format}")
-    with open(audio_file_path, 'wb') as audio_file:
-        audio_file.write(audio_data)
-    logging.info(f"Piper audio generated and saved to {audio_file_path}")
-    return audio_file_path
+
+def _fade_edges(samples, sample_rate, fade_ms=2):
+    """Apply a short linear fade-in and fade-out in place so joined chunks don't click."""
+    fade_len = min(len(samples) // 2, sample_rate * fade_ms // 1000)
+    if fade_len > 0:
+        ramp = np.linspace(0.0, 1.0, fade_len, endpoint=False)
+        samples[:fade_len] = samples[:fade_len] * ramp
+        samples[-fade_len:] = samples[-fade_len:] * ramp[::-1]
+    return samples
+
+
+@functools.lru_cache(maxsize=32)
+def _zero_pcm(n_bytes):
+    return bytes(n_bytes)
+
+
+def _silence_pcm(sample_rate, seconds, sampwidth=2, channels=1):
+    """Zero PCM for `seconds` of silence. Cached by byte length, so every caller shares one buffer per length."""
+    return _zero_pcm(int(seconds * sample_rate) * sampwidth * channels)
+
+
+def _generate_piper_pcm(text, voice_key, speaker_id=0, length_scale=None, noise_scale=None, noise_w=None,
+                        sentence_silence=0.0):
+    """Synthesize text with Piper and return (pcm_bytes, sample_rate, sampwidth, channels).
+
+    Sentences are separated by ``sentence_silence`` seconds of silence, with none after the last one, and the
+    edges are faded so the result can be joined to other chunks.
+    """
+    voice_instance = load_piper_voice(voice_key)
+    sample_rate = voice_instance.config.sample_rate
+    synthesize_args = _piper_synthesize_args(speaker_id, length_scale, noise_scale, noise_w, None)
+    silence = _silence_pcm(sample_rate, sentence_silence)
+    # Accumulate into a bytearray so the fade below can be applied in place without another copy.
+    pcm_bytes = bytearray()
+    for i, sentence_audio in enumerate(voice_instance.synthesize_stream_raw(text, **synthesize_args)):
+        if i:
+            pcm_bytes += silence
+        pcm_bytes += sentence_audio
+    _fade_edges(np.frombuffer(pcm_bytes, dtype=np.int16), sample_rate)
+    return pcm_bytes, sample_rate, 2, 1  # 16-bit mono
+
+
+def _split_text_for_piper(text):
+    """Pack whole sentences into chunks of about PIPER_CHUNK_WORDS words, never more than PIPER_MAX_CHUNK_WORDS."""
+    chunks = []
+    current_sentences = []
+    current_words = 0
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group()
+        # Words are separated by any whitespace run, newlines and tabs included.
+        word_count = len(_WORD_GAP_RE.findall(sentence.rstrip())) + 1
+        if current_sentences and current_words + word_count > PIPER_MAX_CHUNK_WORDS:
+            chunks.append(' '.join(current_sentences))
+            current_sentences, current_words = [], 0
+
+        if word_count > PIPER_MAX_CHUNK_WORDS:
+            # A run-on sentence with no usable punctuation is cut at the hard limit.
+            words = sentence.split()
+            for start in range(0, len(words), PIPER_MAX_CHUNK_WORDS):
+                chunks.append(' '.join(words[start:start + PIPER_MAX_CHUNK_WORDS]))
+            continue
+
+        current_sentences.append(sentence)
+        current_words += word_count
+        if current_words >= PIPER_CHUNK_WORDS:
+            chunks.append(' '.join(current_sentences))
+            current_sentences, current_words = [], 0
+    if current_sentences:
+        chunks.append(' '.join(current_sentences))
+    return chunks
 
 
 def generate_audio_by_splitting_piper(text, voice_key, format_param, speaker_id, length_scale, noise_scale, noise_w,
                                       sentence_silence):
-    """Splits long text for Piper TTS and combines the resulting audio."""
+    """Splits long text for Piper TTS and combines the resulting audio. Returns the encoded audio bytes."""
     if not PIPER_AVAILABLE:
         raise NotImplementedError("piper_tts library is not installed or available.")
 
     logging.info("Piper: Text exceeds limit; splitting into chunks.")
-    words = text.split()
-    paragraphs = []
-    current_paragraph_words = []
-    for word in words:
-        current_paragraph_words.append(word)
-        if len(current_paragraph_words) >= 450 and word.endswith(('.', '!', '?')):
-            paragraphs.append(' '.join(current_paragraph_words))
-            current_paragraph_words = []
-        elif len(current_paragraph_words) >= 500:
-            paragraphs.append(' '.join(current_paragraph_words))
-            current_paragraph_words = []
-    if current_paragraph_words:
-        paragraphs.append(' '.join(current_paragraph_words))
-
-    audio_segments = []
-    for i, paragraph in enumerate(paragraphs):
+    paragraphs = _split_text_for_piper(text)
+    # Load the voice before fanning out so every chunk worker finds it in the cache.
+    load_piper_voice(voice_key)
+
+    # Submit every chunk up front, then collect in submission order so the audio stays in sequence.
+    # Chunks stay in memory as raw PCM; only the combined audio is encoded.
+    futures = [
+        _PIPER_POOL.submit(_generate_piper_pcm, paragraph, voice_key, speaker_id, length_scale, noise_scale, noise_w,
+                           sentence_silence)
+        for paragraph in paragraphs
+    ]
+
+    pcm_parts = []
+    for i, future in enumerate(futures):
         try:
-            audio_file_path_chunk = generate_audio_piper(paragraph, voice_key, 'wav', speaker_id, length_scale,
-                                                         noise_scale, noise_w,
-                                                         sentence_silence if i < len(paragraphs) - 1 else 0.0)
-            audio_segment = pydub.AudioSegment.from_file(audio_file_path_chunk)
-            audio_segments.append(audio_segment)
-            os.remove(audio_file_path_chunk)  # Clean up
+            pcm_bytes, sample_rate, sampwidth, channels = future.result()
+            pcm_parts.append(pcm_bytes)
         except Exception as e:
             logging.error(f"Error generating audio for Piper chunk {i + 1}: {e}")
             raise
 
-    combined_audio = pydub.AudioSegment.empty()
-    for segment in audio_segments:
-        combined_audio += segment
-    combined_audio_file_path = os.path.join(CACHE_DIR, f"{str(uuid.uuid4())}.{format_param}")
-    combined_audio.export(combined_audio_file_path, format=format_param)
-    logging.info(f"Piper combined audio saved to {combined_audio_file_path}")
-    return combined_audio_file_path
+    # Every chunk comes from the same voice, so the PCM can be joined directly in a single allocation.
+    combined_audio = _silence_pcm(sample_rate, sentence_silence, sampwidth, channels).join(pcm_parts)
+    logging.info(f"Piper combined audio generated from {len(pcm_parts)} chunks")
+    if format_param == 'mp3':
+        return encode_mp3(combined_audio, sample_rate, sampwidth, channels)
 
+    audio_buffer = io.BytesIO()
+    with wave.open(audio_buffer, 'wb') as wav_file:
+        wav_file.setframerate(sample_rate)
+        wav_file.setsampwidth(sampwidth)
+        wav_file.setnchannels(channels)
+        wav_file.writeframes(combined_audio)
+    return audio_buffer.getvalue()
 
-def handle_piper_request(data, text, format_param):
-    """Handles logic specific to the Piper TTS engine."""
-    voice_key = data.get('voice', 'en_us').strip()
-    speaker_id = int(data.get('speaker_id', 0))
-    length_scale = float(data.get('length_scale', None)) if data.get('length_scale') else None
-    noise_scale = float(data.get('noise_scale', None)) if data.get('noise_scale') else None
-    noise_w = float(data.get('noise_w', None)) if data.get('noise_w') else None
-    sentence_silence = float(data.get('sentence_silence', 0.0))
 
+def _wav_stream_header(sample_rate, sampwidth=2, channels=1):
+    """Build a 44-byte WAV header for audio of unknown length (RIFF and data sizes set to the maximum)."""
+    byte_rate = sample_rate * sampwidth * channels
+    return struct.pack('<4sL4s4sLHHLLHH4sL', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, channels, sample_rate,
+                       byte_rate, sampwidth * channels, sampwidth * 8, b'data', 0xFFFFFFFF)
+
+
+def _synthesize_sentence(voice_instance, phonemes, synthesize_args):
+    """Synthesize one phonemized sentence and return its faded PCM bytes."""
+    phoneme_ids = voice_instance.phonemes_to_ids(phonemes)
+    audio_bytes = voice_instance.synthesize_ids_to_raw(phoneme_ids, **synthesize_args)
+    samples = np.frombuffer(audio_bytes, dtype=np.int16).copy()
+    return _fade_edges(samples, voice_instance.config.sample_rate).tobytes()
+
+
+def stream_audio_piper(text, voice_key, format='wav', speaker_id=0, length_scale=None, noise_scale=None, noise_w=None,
+                       sentence_silence=0.0):
+    """Stream audio from Piper as each sentence is synthesized.
+
+    WAV output is a header for audio of unknown length followed by raw PCM; MP3 output is the PCM piped through a
+    single ffmpeg process.
+    """
+    logging.info(f"Streaming audio with Piper TTS. Voice: {voice_key}, Format: {format}")
+    # Load eagerly so a bad voice fails before the response starts.
+    voice_instance = load_piper_voice(voice_key)
+    sample_rate = voice_instance.config.sample_rate
+    synthesize_args = _piper_synthesize_args(speaker_id, length_scale, noise_scale, noise_w, None)
+    silence = _silence_pcm(sample_rate, sentence_silence)
+
+    def generate_pcm():
+        sentence_phonemes = voice_instance.phonemize(text)
+        if not sentence_phonemes:
+            return
+
+        # Keep one sentence in flight so the next one is synthesized while the current one is sent.
+        ahead = _PIPER_POOL.submit(_synthesize_sentence, voice_instance, sentence_phonemes[0], synthesize_args)
+        for i in range(len(sentence_phonemes)):
+            audio_bytes = ahead.result()
+            if i + 1 < len(sentence_phonemes):
+                ahead = _PIPER_POOL.submit(_synthesize_sentence, voice_instance, sentence_phonemes[i + 1],
+                                           synthesize_args)
+            yield audio_bytes
+            if silence:
+                yield silence
+
+    def generate_wav():
+        yield _wav_stream_header(sample_rate)
+        yield from generate_pcm()
+
+    if format == 'mp3':
+        return stream_mp3(generate_pcm(), sample_rate)
+    return generate_wav()
+
+
+def _number(data, key, cast, default=None):
+    """Numeric parameter `key` converted with `cast`, or `default` when missing or empty."""
+    value = data.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise InvalidRequestError(f"{key} must be a number.") from None
+
+
+def _fopt(data, key):
+    """Optional float parameter: None when missing or empty, so Piper falls back to the voice's default."""
+    return _number(data, key, float)
+
+
+def _parse_piper_params(data):
+    """Read and validate the Piper-specific request parameters."""
+    voice_key = str(data.get('voice', 'en_us')).strip()
     if voice_key not in AVAILABLE_PIPER_VOICES:
-        raise ValueError(f"Invalid Piper voice. Available voices: {list(AVAILABLE_PIPER_VOICES.keys())}")
+        raise InvalidRequestError(f"Invalid Piper voice. Available voices: {list(AVAILABLE_PIPER_VOICES.keys())}")
 
-    if len(text.split()) > 500:
-        return generate_audio_by_splitting_piper(text, voice_key, format_param, speaker_id, length_scale, noise_scale,
-                                                 noise_w, sentence_silence)
+    sentence_silence = _number(data, 'sentence_silence', float, 0.0)
+    if not 0.0 <= sentence_silence <= PIPER_MAX_SENTENCE_SILENCE:
+        raise InvalidRequestError(f"sentence_silence must be between 0 and {PIPER_MAX_SENTENCE_SILENCE} seconds.")
+
+    return {
+        'voice_key': voice_key,
+        'speaker_id': _number(data, 'speaker_id', int, 0),
+        'length_scale': _fopt(data, 'length_scale'),
+        'noise_scale': _fopt(data, 'noise_scale'),
+        'noise_w': _fopt(data, 'noise_w'),
+        'sentence_silence': sentence_silence,
+    }
+
+
+def handle_piper_request(data, text, format_param):
+    """Handles logic specific to the Piper TTS engine."""
+    params = _parse_piper_params(data)
+
+    # Counting whitespace gaps gives the word count without building a word list just to decide.
+    approx_words = len(_WORD_GAP_RE.findall(text)) + 1
+    if approx_words > PIPER_MAX_CHUNK_WORDS:
+        return generate_audio_by_splitting_piper(text, format_param=format_param, **params)
     else:
-        return generate_audio_piper(text, voice_key, format_param, speaker_id, length_scale, noise_scale, noise_w,
-                                    sentence_silence)
+        return generate_audio_piper(text, format=format_param, **params)
+
+
+def handle_piper_stream_request(data, text, format_param):
+    """Handles a streamed Piper request, returning a generator of encoded audio bytes."""
+    params = _parse_piper_params(data)
+    return stream_audio_piper(text, format=format_param, **params)
@@ -0,0 +1,19 @@
+# gunicorn_conf.py
+# Production server settings. Run with: gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('APP_PORT', '17100')}"
+
+# Threaded workers: Piper's ONNX inference releases the GIL and Google API calls wait on the network,
+# so several requests per worker can make progress at the same time. The Piper chunk pool, the job executor
+# and the shared asyncio loop all need real OS threads, so green-thread workers (gevent/eventlet) are not supported.
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# Long texts can take a while to synthesize.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
@@ -26,6 +26,7 @@ class PiperVoice:
         model_path: Union[str, Path],
         config_path: Optional[Union[str, Path]] = None,
         use_cuda: bool = False,
+        sess_options: Optional[onnxruntime.SessionOptions] = None,
     ) -> "PiperVoice":
         """Load an ONNX model and config."""
         if config_path is None:
@@ -40,7 +41,8 @@ class PiperVoice:
                 (
                     "CUDAExecutionProvider",
                     {"cudnn_conv_algo_search": "HEURISTIC"},
-                )
+                ),
+                "CPUExecutionProvider",
             ]
         else:
             providers = ["CPUExecutionProvider"]
@@ -49,7 +51,7 @@ class PiperVoice:
             config=PiperConfig.from_dict(config_dict),
             session=onnxruntime.InferenceSession(
                 str(model_path),
-                sess_options=onnxruntime.SessionOptions(),
+                sess_options=sess_options or onnxruntime.SessionOptions(),
                 providers=providers,
             ),
         )
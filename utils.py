@@ -1,21 +1,244 @@
 # utils.py
+import asyncio
+import hashlib
+import json
 import os
+import secrets
+import subprocess
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-CACHE_DIR = os.path.join(os.getcwd(), 'cache')
-os.makedirs(CACHE_DIR, exist_ok=True)
+import numpy as np
 
-def clear_audio_cache():
+try:
+    import lameenc  # Optional: encodes MP3 in-process; without it MP3 goes through an ffmpeg subprocess
+except ImportError:
+    lameenc = None
+
+# The one audio cache directory for every engine; resolved once so a later chdir can't move it.
+CACHE_DIR = Path(os.getenv('TTS_CACHE_DIR', Path.cwd() / 'cache')).resolve()
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+CACHE_CLEANUP_INTERVAL = int(os.getenv('CACHE_CLEANUP_INTERVAL', '3600'))
+CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))
+
+
+class InvalidRequestError(ValueError):
+    """Bad client input found by an engine's parameter parsing; the API answers it with 400."""
+
+
+def cache_key(engine, text, params):
+    """SHA-256 key for a synthesis request. Identical (engine, text, params) always map to the same key."""
+    normalized = json.dumps({k: v for k, v in params.items() if k != 'text'} | {'engine': engine}, sort_keys=True)
+    return hashlib.sha256(normalized.encode() + b'\0' + text.encode()).hexdigest()
+
+
+# Cache files are written by one background thread, so responses don't wait on disk writes.
+_cache_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-writer')
+
+
+def _write_cache_file(path, data):
+    # Write under a temporary name and rename, so concurrent readers never see a partial file.
+    tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+        logging.info(f"Audio saved to {path}")
+    except OSError as e:
+        logging.error(f"Error writing cache file {path}: {e}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def write_cache_file(path, data):
+    """Queue `data` to be written to the cache at `path`. Returns a future that completes once it is on disk."""
+    return _cache_writer.submit(_write_cache_file, path, data)
+
+
+def _remove_cache_file(entry, reason):
+    try:
+        os.unlink(entry.path)
+        logging.info(f"Removed {reason} cache file: {entry.name}")
+        return True
+    except OSError as e:
+        logging.error(f"Error removing cache file: {e}")
+        return False
+
+
+def clear_audio_cache(max_bytes=CACHE_MAX_BYTES):
+    """Remove cache files unused for a day, then evict least recently used files until under `max_bytes`.
+
+    Cache hits refresh a file's mtime, so mtime order is recency order.
+    """
     one_day_in_seconds = 86400
-    current_time = time.time()
-    for filename in os.listdir(CACHE_DIR):
-        file_path = os.path.join(CACHE_DIR, filename)
-        if os.path.isfile(file_path):
-            file_mtime = os.path.getmtime(file_path)
-            if (current_time - file_mtime) > one_day_in_seconds:
-                try:
-                    os.remove(file_path)
-                    logging.info(f"Removed old cache file: {filename}")
-                except OSError as e:
-                    logging.error(f"Error removing cache file: {e}")
+    cutoff = time.time() - one_day_in_seconds
+    kept = []
+    # scandir hands back the entry type with the listing and caches stat(), avoiding extra syscalls per file.
+    with os.scandir(CACHE_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime < cutoff:
+                _remove_cache_file(entry, 'old')
+            else:
+                kept.append((stat.st_mtime, stat.st_size, entry))
+
+    total_bytes = sum(size for _, size, _ in kept)
+    if total_bytes <= max_bytes:
+        return
+    kept.sort(key=lambda item: item[0])
+    for _, size, entry in kept:
+        if total_bytes <= max_bytes:
+            break
+        if _remove_cache_file(entry, 'least recently used'):
+            total_bytes -= size
+
+
+def schedule_audio_cache_cleanup(interval=CACHE_CLEANUP_INTERVAL):
+    """Clear the audio cache now and every `interval` seconds on a background thread."""
+    def run():
+        try:
+            clear_audio_cache()
+        except OSError as e:
+            logging.error(f"Error clearing audio cache: {e}")
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+
+    thread = threading.Thread(target=run, name='cache-cleanup', daemon=True)
+    thread.start()
+
+
+# A single background event loop shared by the async API clients (e.g. Google Cloud), so blocking Flask
+# threads can hand off network calls and many of them can be in flight at once.
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def _get_async_loop():
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name='async-io', daemon=True).start()
+        return _async_loop
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared background event loop and block until it returns."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result(timeout)
+
+
+def iterate_async(async_iterable, timeout=None):
+    """Iterate an async iterable from sync code, pulling each item through the shared background event loop."""
+    iterator = async_iterable.__aiter__()
+
+    async def next_item():
+        try:
+            return False, await iterator.__anext__()
+        except StopAsyncIteration:
+            return True, None
+
+    while True:
+        exhausted, item = run_async(next_item(), timeout)
+        if exhausted:
+            return
+        yield item
+
+
+def ffmpeg_mp3_command(sample_rate, sampwidth=2, channels=1):
+    """ffmpeg arguments that read raw PCM from stdin and write MP3 to stdout."""
+    sample_format = {1: 'u8', 2: 's16le', 4: 's32le'}[sampwidth]
+    return ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', sample_format, '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0',
+            '-codec:a', 'libmp3lame', '-b:a', '128k', '-f', 'mp3', 'pipe:1']
+
+
+def _lame_encoder(sample_rate, channels):
+    """A fresh lameenc encoder matching the ffmpeg settings (128 kbps). Encoders can't be reused after flush()."""
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(128)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(channels)
+    encoder.set_quality(2)
+    return encoder
+
+
+def _use_lameenc(sampwidth, channels):
+    # lameenc only takes 16-bit mono or stereo PCM
+    return lameenc is not None and sampwidth == 2 and channels in (1, 2)
+
+
+def encode_mp3(pcm_bytes, sample_rate, sampwidth=2, channels=1):
+    """Encode raw PCM to MP3, in-process with lameenc when installed, otherwise with one ffmpeg process."""
+    if _use_lameenc(sampwidth, channels):
+        encoder = _lame_encoder(sample_rate, channels)
+        mp3_data = encoder.encode(pcm_bytes)
+        mp3_data += encoder.flush()
+        return bytes(mp3_data)
+
+    result = subprocess.run(ffmpeg_mp3_command(sample_rate, sampwidth, channels), input=pcm_bytes,
+                            capture_output=True)
+    if result.returncode != 0:
+        logging.error(f"ffmpeg MP3 encoding failed: {result.stderr.decode(errors='replace').strip()}")
+        raise RuntimeError("MP3 encoding failed.")
+    return result.stdout
+
+
+def stream_mp3(pcm_chunks, sample_rate, sampwidth=2, channels=1):
+    """Encode a stream of raw PCM chunks to MP3, yielding MP3 data as soon as it is produced."""
+    if _use_lameenc(sampwidth, channels):
+        encoder = _lame_encoder(sample_rate, channels)
+        for chunk in pcm_chunks:
+            mp3_data = encoder.encode(chunk)
+            if mp3_data:
+                yield bytes(mp3_data)
+        yield bytes(encoder.flush())
+        return
+
+    process = subprocess.Popen(ffmpeg_mp3_command(sample_rate, sampwidth, channels), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        # Runs on its own thread so synthesis keeps ffmpeg's stdin full while the caller drains stdout.
+        try:
+            for chunk in pcm_chunks:
+                process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass  # ffmpeg was stopped because the client went away
+        except Exception as e:
+            logging.error(f"Error during Piper streaming synthesis: {e}")
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, name='ffmpeg-feed', daemon=True)
+    feeder.start()
+    try:
+        while True:
+            data = process.stdout.read1(65536)
+            if not data:
+                break
+            yield data
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        if process.wait() not in (0, -9):
+            logging.error(f"ffmpeg MP3 streaming exited with code {process.returncode}")
+
+
+def float_to_int16(samples):
+    """Quantize float samples in [-1, 1] to int16 in one vectorized pass (clip, scale in place, cast)."""
+    scaled = np.clip(samples, -1.0, 1.0)
+    scaled *= 32767
+    return scaled.astype(np.int16)